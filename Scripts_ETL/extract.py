@@ -1,5 +1,5 @@
-import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import os
 from typing import List, Tuple
@@ -18,6 +18,55 @@ SELECTED_COLUMNS = [
     'total_amount'
 ]
 
+# Nombre de lignes traitées à la fois : borne la mémoire à un lot
+BATCH_SIZE = 200_000
+
+# Options d'écriture Parquet : zstd et dictionnaire pour les colonnes peu variées
+PARQUET_OPTIONS = {
+    'compression': 'zstd',
+    'compression_level': 3,
+    'use_dictionary': ['VendorID', 'payment_type'],
+    'data_page_size': 1 << 20,
+    'write_statistics': True
+}
+
+def clean_batch(table: pa.Table) -> pa.Table:
+    """Nettoie et type un lot de données extraites"""
+    # Conversion des dates (heure locale, sans fuseau)
+    date_cols = ['tpep_pickup_datetime', 'tpep_dropoff_datetime']
+    for col in date_cols:
+        dates = table[col]
+        if dates.type.tz is not None:
+            dates = pc.local_timestamp(dates)
+        table = table.set_column(
+            table.schema.get_field_index(col),
+            col,
+            pc.cast(dates, pa.timestamp('ns'))
+        )
+
+    # Nettoyage des données : filtrage des dates manquantes côté Arrow
+    valid_dates = pc.and_(
+        pc.is_valid(table[date_cols[0]]),
+        pc.is_valid(table[date_cols[1]])
+    )
+    table = table.filter(valid_dates)
+
+    # Conversion des types numériques
+    int_cols = ['VendorID', 'passenger_count', 'PULocationID', 'DOLocationID']
+    for col in int_cols:
+        table = table.set_column(
+            table.schema.get_field_index(col),
+            col,
+            pc.cast(pc.fill_null(table[col], 0), pa.int16())
+        )
+    table = table.set_column(
+        table.schema.get_field_index('payment_type'),
+        'payment_type',
+        pc.dictionary_encode(table['payment_type'])
+    )
+
+    return table
+
 def extract_data(required_cols: List[str] = SELECTED_COLUMNS):
     """Extrait et transforme les données depuis un fichier Parquet"""
     
@@ -31,41 +80,36 @@ def extract_data(required_cols: List[str] = SELECTED_COLUMNS):
     print(f"🎯 Cible : {output_path}")
 
     try:
-        # Lecture avec PyArrow
-        table = pq.read_table(input_path)
-        df = table.to_pandas()
-
-        # Sélection des colonnes
-        df = df[required_cols]
+        # Lecture par lots avec PyArrow (seules les colonnes utiles sont décodées)
+        source = pq.ParquetFile(input_path, memory_map=True)
+        writer = None
+        total_rows = 0
 
-        # Conversion des dates
-        date_cols = ['tpep_pickup_datetime', 'tpep_dropoff_datetime']
-        for col in date_cols:
-            df[col] = pd.to_datetime(df[col], errors='coerce').dt.tz_localize(None)
+        try:
+            for batch in source.iter_batches(
+                batch_size=BATCH_SIZE,
+                columns=required_cols,
+                use_threads=True
+            ):
+                table = clean_batch(pa.Table.from_batches([batch]))
+                if table.num_rows == 0:
+                    continue
 
-        # Nettoyage des données
-        df = df.dropna(subset=date_cols)
-        df = df.convert_dtypes()
-
-        # Conversion des types numériques
-        int_cols = ['VendorID', 'passenger_count', 'PULocationID', 'DOLocationID']
-        df[int_cols] = df[int_cols].fillna(0).astype('int16')
-        df['payment_type'] = df['payment_type'].astype('category')
+                # Sauvegarde au fil de l'eau
+                if writer is None:
+                    os.makedirs(output_dir, exist_ok=True)
+                    writer = pq.ParquetWriter(output_path, table.schema, **PARQUET_OPTIONS)
+                writer.write_table(table, row_group_size=BATCH_SIZE)
+                total_rows += table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
 
         # Validation finale
-        if df.empty:
+        if total_rows == 0:
             raise ValueError("Aucune donnée valide après traitement")
 
-        # Sauvegarde
-        os.makedirs(output_dir, exist_ok=True)
-        df.to_parquet(
-            output_path,
-            engine='pyarrow',
-            compression='snappy',
-            index=False
-        )
-
-        print(f"\n✅ Succès ! {len(df)} lignes sauvegardées")
+        print(f"\n✅ Succès ! {total_rows} lignes sauvegardées")
         return True
 
     except Exception as e:
@@ -1,72 +1,103 @@
 import pandas as pd
+import numpy as np
+import io
 import os
+import pyarrow.parquet as pq
 import sqlalchemy as sa
-from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy import MetaData, Table
+from psycopg2.extras import execute_values
+
+FACT_COLUMNS = [
+    'time_pk',
+    'pickup_loc_pk',
+    'dropoff_loc_pk',
+    'payment_pk',
+    'passenger_count',
+    'trip_distance',
+    'fare_amount',
+    'total_amount',
+    'duration_min',
+    'avg_speed'
+]
+
+def _to_rows(df: pd.DataFrame) -> list:
+    """Convertit un DataFrame en tuples de types Python natifs pour psycopg2"""
+    return list(zip(*(df[col].tolist() for col in df.columns)))
+
+def _lookup_keys(values: pd.Series, natural_keys: pd.Series, surrogate_keys: pd.Series) -> np.ndarray:
+    """Résout les clés de substitution d'une dimension, -1 si la clé naturelle est absente"""
+    positions = pd.Index(natural_keys).get_indexer(values)
+    return np.where(positions >= 0, surrogate_keys.to_numpy()[positions], -1)
+
+def _upsert_dimension(cursor, table: str, rows: pd.DataFrame, natural_key: str, surrogate_key: str) -> pd.DataFrame:
+    """Insère les lignes d'une dimension et renvoie ses clés via RETURNING"""
+    if rows.empty:
+        return pd.DataFrame(columns=[surrogate_key, natural_key])
+
+    # DO UPDATE (et non DO NOTHING) pour que RETURNING renvoie aussi les lignes existantes
+    keys = execute_values(
+        cursor,
+        f"INSERT INTO {table} ({', '.join(rows.columns)}) VALUES %s "
+        f"ON CONFLICT ({natural_key}) DO UPDATE SET {natural_key} = EXCLUDED.{natural_key} "
+        f"RETURNING {surrogate_key}, {natural_key}",
+        _to_rows(rows),
+        page_size=10000,
+        fetch=True
+    )
+    return pd.DataFrame(keys, columns=[surrogate_key, natural_key])
 
 def create_star_schema(engine):
     """Crée le schéma en étoile optimisé pour les données taxi"""
     
-    with engine.connect() as conn:
-        # Suppression des tables existantes
-        conn.execute(sa.text("DROP TABLE IF EXISTS fact_trips CASCADE"))
-        conn.execute(sa.text("DROP TABLE IF EXISTS dim_time CASCADE"))
-        conn.execute(sa.text("DROP TABLE IF EXISTS dim_location CASCADE"))
-        conn.execute(sa.text("DROP TABLE IF EXISTS dim_payment CASCADE"))
-        conn.commit()
-
-        # Création des tables de dimension
-        conn.execute(sa.text("""
-            CREATE TABLE dim_time (
-                time_pk SERIAL PRIMARY KEY,
-                datetime TIMESTAMP UNIQUE NOT NULL,
-                hour SMALLINT NOT NULL CHECK (hour BETWEEN 0 AND 23),
-                day_of_week VARCHAR(9) NOT NULL,
-                time_period VARCHAR(20) NOT NULL
-            )
-        """))
-        
-        conn.execute(sa.text("""
-            CREATE TABLE dim_location (
-                location_pk SERIAL PRIMARY KEY,
-                location_id INTEGER UNIQUE NOT NULL,
-                borough VARCHAR(50) NOT NULL DEFAULT 'Inconnu'
-            )
-        """))
-        
-        conn.execute(sa.text("""
-            CREATE TABLE dim_payment (
-                payment_pk SERIAL PRIMARY KEY,
-                payment_type VARCHAR(20) UNIQUE NOT NULL
-            )
-        """))
-        
-        # Création de la table de faits avec optimisations
-        conn.execute(sa.text("""
-            CREATE TABLE fact_trips (
-                trip_id BIGSERIAL PRIMARY KEY,
-                time_pk INTEGER NOT NULL REFERENCES dim_time(time_pk),
-                pickup_loc_pk INTEGER NOT NULL REFERENCES dim_location(location_pk),
-                dropoff_loc_pk INTEGER NOT NULL REFERENCES dim_location(location_pk),
-                payment_pk INTEGER NOT NULL REFERENCES dim_payment(payment_pk),
-                passenger_count SMALLINT CHECK (passenger_count > 0),
-                trip_distance NUMERIC(8,2) CHECK (trip_distance > 0),
-                fare_amount NUMERIC(8,2) CHECK (fare_amount > 0),
-                total_amount NUMERIC(8,2) CHECK (total_amount > 0),
-                duration_min NUMERIC(8,2) CHECK (duration_min > 0),
-                avg_speed NUMERIC(8,2) CHECK (avg_speed > 0)
-            )
-        """))
-        
-        # Création d'index pour les requêtes courantes
-        conn.execute(sa.text("""
-            CREATE INDEX idx_fact_time ON fact_trips(time_pk)
-        """))
-        conn.execute(sa.text("""
-            CREATE INDEX idx_fact_payment ON fact_trips(payment_pk)
-        """))
-        
-        conn.commit()
+    # Script DDL complet, envoyé en un seul aller-retour
+    script = """
+        -- Suppression des tables existantes
+        DROP TABLE IF EXISTS fact_trips CASCADE;
+        DROP TABLE IF EXISTS dim_time CASCADE;
+        DROP TABLE IF EXISTS dim_location CASCADE;
+        DROP TABLE IF EXISTS dim_payment CASCADE;
+
+        -- Création des tables de dimension
+        CREATE TABLE dim_time (
+            time_pk SERIAL PRIMARY KEY,
+            datetime TIMESTAMP UNIQUE NOT NULL,
+            hour SMALLINT NOT NULL CHECK (hour BETWEEN 0 AND 23),
+            day_of_week VARCHAR(9) NOT NULL,
+            time_period VARCHAR(20) NOT NULL
+        );
+
+        CREATE TABLE dim_location (
+            location_pk SERIAL PRIMARY KEY,
+            location_id INTEGER UNIQUE NOT NULL,
+            borough VARCHAR(50) NOT NULL DEFAULT 'Inconnu'
+        );
+
+        CREATE TABLE dim_payment (
+            payment_pk SERIAL PRIMARY KEY,
+            payment_type VARCHAR(20) UNIQUE NOT NULL
+        );
+
+        -- Création de la table de faits avec optimisations
+        CREATE TABLE fact_trips (
+            trip_id BIGSERIAL PRIMARY KEY,
+            time_pk INTEGER NOT NULL REFERENCES dim_time(time_pk),
+            pickup_loc_pk INTEGER NOT NULL REFERENCES dim_location(location_pk),
+            dropoff_loc_pk INTEGER NOT NULL REFERENCES dim_location(location_pk),
+            payment_pk INTEGER NOT NULL REFERENCES dim_payment(payment_pk),
+            passenger_count SMALLINT CHECK (passenger_count > 0),
+            trip_distance REAL CHECK (trip_distance > 0),
+            fare_amount REAL CHECK (fare_amount > 0),
+            total_amount REAL CHECK (total_amount > 0),
+            duration_min REAL CHECK (duration_min > 0),
+            avg_speed REAL CHECK (avg_speed > 0)
+        );
+
+        -- Création d'index pour les requêtes courantes
+        CREATE INDEX idx_fact_time ON fact_trips(time_pk);
+        CREATE INDEX idx_fact_payment ON fact_trips(payment_pk);
+    """
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql(script)
 
 def load_to_dw():
     """Charge les données transformées dans le Data Warehouse"""
@@ -104,90 +135,66 @@ def load_to_dw():
         print("✅ Schéma en étoile créé avec succès")
 
         # Chargement des données transformées
-        df = pd.read_parquet(input_path)
+        table = pq.read_table(input_path, memory_map=True)
+        df = table.to_pandas(ignore_metadata=True, self_destruct=True)
+        del table
         print(f"📊 Données transformées chargées : {len(df)} lignes")
 
         with engine.begin() as connection:
-            metadata = MetaData()
+            # Curseur psycopg2 brut pour les insertions par lots, dans la même transaction
+            cursor = connection.connection.cursor()
 
             # Chargement de la dimension Temps
-            time_df = df[['tpep_pickup_datetime', 'day_of_week', 'time_period']].copy()
+            # Une ligne par horodatage distinct : les autres attributs en découlent
+            _, first_rows = np.unique(df['tpep_pickup_datetime'].to_numpy(), return_index=True)
+            time_df = df.iloc[first_rows][['tpep_pickup_datetime', 'day_of_week', 'time_period']]
             time_df = time_df.rename(columns={'tpep_pickup_datetime': 'datetime'})
             time_df['hour'] = time_df['datetime'].dt.hour.astype('int16')
-            time_df = time_df[['datetime', 'hour', 'day_of_week', 'time_period']].drop_duplicates()
+            time_df = time_df[['datetime', 'hour', 'day_of_week', 'time_period']]
             
-            dim_time = Table('dim_time', metadata, autoload_with=engine)
+            time_keys = _upsert_dimension(cursor, 'dim_time', time_df, 'datetime', 'time_pk')
             if not time_df.empty:
-                stmt = insert(dim_time).values(time_df.to_dict('records'))
-                stmt = stmt.on_conflict_do_nothing(index_elements=['datetime'])
-                connection.execute(stmt)
                 print(f"🕒 Dim Temps : {len(time_df)} lignes insérées")
 
             # Chargement de la dimension Localisation
-            locations = pd.concat([
-                df['PULocationID'].rename('location_id'),
-                df['DOLocationID'].rename('location_id')
-            ]).drop_duplicates().to_frame()
+            location_ids = np.unique(np.concatenate([
+                df['PULocationID'].to_numpy(dtype=np.int32),
+                df['DOLocationID'].to_numpy(dtype=np.int32)
+            ]))
+            locations = pd.DataFrame({'location_id': location_ids})
             
-            dim_location = Table('dim_location', metadata, autoload_with=engine)
+            loc_keys = _upsert_dimension(cursor, 'dim_location', locations, 'location_id', 'location_pk')
             if not locations.empty:
-                stmt = insert(dim_location).values(locations.to_dict('records'))
-                stmt = stmt.on_conflict_do_nothing(index_elements=['location_id'])
-                connection.execute(stmt)
                 print(f"📍 Dim Localisation : {len(locations)} lignes insérées")
 
             # Chargement de la dimension Paiement
             payments = df[['payment_label']].drop_duplicates().rename(columns={'payment_label': 'payment_type'})
             
-            dim_payment = Table('dim_payment', metadata, autoload_with=engine)
+            payment_keys = _upsert_dimension(cursor, 'dim_payment', payments, 'payment_type', 'payment_pk')
             if not payments.empty:
-                stmt = insert(dim_payment).values(payments.to_dict('records'))
-                stmt = stmt.on_conflict_do_nothing(index_elements=['payment_type'])
-                connection.execute(stmt)
                 print(f"💳 Dim Paiement : {len(payments)} lignes insérées")
 
-            # Récupération des clés étrangères
-            time_keys = pd.read_sql("SELECT time_pk, datetime FROM dim_time", connection)
-            loc_keys = pd.read_sql("SELECT location_pk, location_id FROM dim_location", connection)
-            payment_keys = pd.read_sql("SELECT payment_pk, payment_type FROM dim_payment", connection)
-
-            # Préparation des données de faits
-            fact_data = df.merge(
-                time_keys,
-                left_on='tpep_pickup_datetime',
-                right_on='datetime'
-            ).merge(
-                loc_keys,
-                left_on='PULocationID',
-                right_on='location_id'
-            ).merge(
-                loc_keys,
-                left_on='DOLocationID',
-                right_on='location_id',
-                suffixes=('_pu', '_do')
-            ).merge(
-                payment_keys,
-                left_on='payment_label',
-                right_on='payment_type'
-            )
-
-            # Sélection et formatage des colonnes
-            fact_data = fact_data[[
-                'time_pk', 
-                'location_pk_pu', 
-                'location_pk_do', 
-                'payment_pk',
-                'passenger_count', 
-                'trip_distance', 
-                'fare_amount', 
-                'total_amount',
-                'trip_duration',
-                'avg_speed'
-            ]].rename(columns={
-                'location_pk_pu': 'pickup_loc_pk',
-                'location_pk_do': 'dropoff_loc_pk',
-                'trip_duration': 'duration_min'
-            })
+            # Préparation des données de faits par recherche directe des clés
+            time_pk = _lookup_keys(df['tpep_pickup_datetime'], time_keys['datetime'], time_keys['time_pk'])
+            pickup_loc_pk = _lookup_keys(df['PULocationID'], loc_keys['location_id'], loc_keys['location_pk'])
+            dropoff_loc_pk = _lookup_keys(df['DOLocationID'], loc_keys['location_id'], loc_keys['location_pk'])
+            payment_pk = _lookup_keys(df['payment_label'], payment_keys['payment_type'], payment_keys['payment_pk'])
+
+            # Seules les courses dont toutes les clés sont résolues sont conservées
+            matched = (time_pk >= 0) & (pickup_loc_pk >= 0) & (dropoff_loc_pk >= 0) & (payment_pk >= 0)
+
+            fact_data = pd.DataFrame({
+                'time_pk': time_pk,
+                'pickup_loc_pk': pickup_loc_pk,
+                'dropoff_loc_pk': dropoff_loc_pk,
+                'payment_pk': payment_pk,
+                'passenger_count': df['passenger_count'].to_numpy(),
+                'trip_distance': df['trip_distance'].to_numpy(),
+                'fare_amount': df['fare_amount'].to_numpy(),
+                'total_amount': df['total_amount'].to_numpy(),
+                'duration_min': df['trip_duration'].to_numpy(),
+                'avg_speed': df['avg_speed'].to_numpy()
+            })[matched]
 
             # Conversion des types
             fact_data = fact_data.astype({
@@ -199,25 +206,14 @@ def load_to_dw():
                 'avg_speed': 'float32'
             })
 
-            # Insertion des données de faits
+            # Insertion des données de faits en un seul flux COPY
             if not fact_data.empty:
-                fact_data.to_sql(
-                    'fact_trips', 
-                    connection, 
-                    if_exists='append', 
-                    index=False,
-                    dtype={
-                        'time_pk': sa.Integer(),
-                        'pickup_loc_pk': sa.Integer(),
-                        'dropoff_loc_pk': sa.Integer(),
-                        'payment_pk': sa.Integer(),
-                        'passenger_count': sa.SmallInteger(),
-                        'trip_distance': sa.Numeric(8,2),
-                        'fare_amount': sa.Numeric(8,2),
-                        'total_amount': sa.Numeric(8,2),
-                        'duration_min': sa.Numeric(8,2),
-                        'avg_speed': sa.Numeric(8,2)
-                    }
+                buffer = io.StringIO()
+                fact_data[FACT_COLUMNS].to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cursor.copy_expert(
+                    f"COPY fact_trips ({', '.join(FACT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                    buffer
                 )
                 print(f"🚕 Faits Taxi : {len(fact_data)} lignes insérées")
 
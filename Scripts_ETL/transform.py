@@ -1,7 +1,9 @@
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
 import os
 import json
+from collections import Counter
 from datetime import datetime
 from typing import Tuple
 import logging
@@ -13,17 +15,103 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# Raisons de rejet, par ordre de priorité
+REJECTION_REASONS = [
+    'Durée invalide',
+    'Distance hors limites',
+    'Montant de course invalide',
+    'Passagers invalides',
+    'Vitesse irréaliste'
+]
+
+# Options d'écriture Parquet : zstd et dictionnaire pour les colonnes peu variées
+PARQUET_OPTIONS = {
+    'compression': 'zstd',
+    'compression_level': 3,
+    'use_dictionary': [
+        'VendorID',
+        'payment_type',
+        'day_of_week',
+        'time_period',
+        'payment_label',
+        'ratecode_label',
+        'rejection_reason'
+    ],
+    'row_group_size': 200_000,
+    'data_page_size': 1 << 20,
+    'write_statistics': True
+}
+
+# Jours de la semaine (lundi = 0), libellés identiques à Series.dt.day_name()
+DAY_NAMES = [
+    'Monday',
+    'Tuesday',
+    'Wednesday',
+    'Thursday',
+    'Friday',
+    'Saturday',
+    'Sunday'
+]
+
+# Périodes de la journée par tranche de 6 heures
+TIME_PERIODS = ['Nuit', 'Matin', 'Après-midi', 'Soir']
+
+def _encode_labels(values: pd.Series, labels: dict) -> pd.Categorical:
+    """Associe des codes entiers à leurs libellés via une table de correspondance NumPy"""
+    lookup = np.full(max(labels) + 1, -1, dtype=np.int8)
+    lookup[list(labels)] = np.arange(len(labels))
+
+    # Les codes absents de la table (ou manquants) restent à -1, soit NaN
+    raw = values.to_numpy(dtype='float64', na_value=np.nan)
+    known = np.isin(raw, list(labels))
+    codes = np.full(len(raw), -1, dtype=np.int8)
+    codes[known] = lookup[raw[known].astype(np.int64)]
+
+    return pd.Categorical.from_codes(codes, list(labels.values()))
+
+def drop_duplicate_trips(df: pd.DataFrame) -> pd.DataFrame:
+    """Supprime les courses en double (mêmes horodatages de prise en charge et de dépose)"""
+    pickup = df['tpep_pickup_datetime'].to_numpy(dtype='datetime64[ns]').view(np.uint64)
+    dropoff = df['tpep_dropoff_datetime'].to_numpy(dtype='datetime64[ns]').view(np.uint64)
+
+    # Clé de hachage 64 bits du couple d'horodatages (risque de collision négligeable)
+    keys = (pickup * np.uint64(0x9E3779B97F4A7C15)) ^ dropoff
+
+    # Première occurrence de chaque clé, dans l'ordre d'origine
+    _, first_rows = np.unique(keys, return_index=True)
+    return df.iloc[np.sort(first_rows)]
+
 class DataTransformer:
     def __init__(self):
-        self.anomalies = pd.DataFrame()
+        # Anomalies conservées sous forme (DataFrame source, positions, codes de raison)
+        self.anomaly_batches = []
+        self.anomaly_counts = Counter()
         self.stats = {}
         self.log = []
         self.df = pd.DataFrame()
 
+    @property
+    def anomaly_count(self) -> int:
+        """Nombre total de lignes rejetées"""
+        return sum(self.anomaly_counts.values())
+
+    @property
+    def anomalies(self) -> pd.DataFrame:
+        """Lignes rejetées avec leur raison, matérialisées à la demande"""
+        if not self.anomaly_batches:
+            return pd.DataFrame()
+        return pd.concat([
+            source.iloc[rows].assign(
+                rejection_reason=pd.Categorical.from_codes(codes, REJECTION_REASONS)
+            )
+            for source, rows, codes in self.anomaly_batches
+        ])
+
     def load_data(self, input_path: str) -> pd.DataFrame:
         """Charge les données extraites"""
         try:
-            self.df = pd.read_parquet(input_path)
+            table = pq.read_table(input_path, memory_map=True)
+            self.df = table.to_pandas(ignore_metadata=True, self_destruct=True)
             logging.info(f"Données chargées : {len(self.df)} lignes")
             return self.df
         except Exception as e:
@@ -32,60 +120,78 @@ class DataTransformer:
 
     def calculate_metrics(self, df: pd.DataFrame) -> pd.DataFrame:
         """Calcule les métriques de transformation"""
-        df['trip_duration'] = (
-            df['tpep_dropoff_datetime'] - df['tpep_pickup_datetime']
-        ).dt.total_seconds() / 60
-        
-        df['avg_speed'] = df['trip_distance'] / (df['trip_duration']/60)
-        df['avg_speed'] = df['avg_speed'].round(2)
+        # Horodatages en nanosecondes (int64) pour travailler sur les tableaux bruts
+        pickup = df['tpep_pickup_datetime'].to_numpy(dtype='datetime64[ns]').view('i8')
+        dropoff = df['tpep_dropoff_datetime'].to_numpy(dtype='datetime64[ns]').view('i8')
+        distance = df['trip_distance'].to_numpy(dtype='float64', na_value=np.nan)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            duration = (dropoff - pickup) / 60e9
+            speed = np.round(distance / (duration / 60), 2)
+
+        df['trip_duration'] = duration.astype(np.float32)
+        df['avg_speed'] = speed.astype(np.float32)
         
         return df
 
     def handle_anomalies(self, df: pd.DataFrame) -> pd.DataFrame:
         """Détecte et gère les anomalies avec des raisons spécifiques"""
-        # Création de masques pour chaque type d'anomalie
-        conditions = {
-            'Durée invalide': (df['trip_duration'] <= 0),
-            'Distance hors limites': ~df['trip_distance'].between(0.1, 100),
-            'Montant de course invalide': (df['fare_amount'] <= 0),
-            'Passagers invalides': (df['passenger_count'] <= 0),
-            'Vitesse irréaliste': ~df['avg_speed'].between(1, 100)
-        }
+        duration = df['trip_duration'].to_numpy(dtype='float64', na_value=np.nan)
+        distance = df['trip_distance'].to_numpy(dtype='float64', na_value=np.nan)
+        fare = df['fare_amount'].to_numpy(dtype='float64', na_value=np.nan)
+        passengers = df['passenger_count'].to_numpy(dtype='float64', na_value=np.nan)
+        speed = df['avg_speed'].to_numpy(dtype='float64', na_value=np.nan)
 
-        # Création d'une colonne de raison par défaut
-        df['rejection_reason'] = np.nan
+        # Un masque par type d'anomalie, dans l'ordre de REJECTION_REASONS
+        conditions = [
+            duration <= 0,
+            ~((distance >= 0.1) & (distance <= 100)),
+            fare <= 0,
+            passengers <= 0,
+            ~((speed >= 1) & (speed <= 100))
+        ]
 
-        # Application des masques avec priorité
-        for reason, mask in conditions.items():
-            anomaly_mask = mask & df['rejection_reason'].isna()
-            df.loc[anomaly_mask, 'rejection_reason'] = reason
+        # La première condition vérifiée l'emporte, -1 si aucune
+        codes = np.select(conditions, list(range(len(REJECTION_REASONS))), default=-1)
 
-        # Séparation des anomalies
-        anomalies = df[df['rejection_reason'].notna()].copy()
-        valid_data = df[df['rejection_reason'].isna()].drop(columns=['rejection_reason'])
+        # Séparation des anomalies en une seule partition du masque :
+        # seules les positions et raisons des lignes rejetées sont conservées
+        valid = codes < 0
+        rejected = np.flatnonzero(~valid)
+        valid_data = df.iloc[np.flatnonzero(valid)]
 
         # Enregistrement des anomalies
-        if not anomalies.empty:
-            self.anomalies = pd.concat([self.anomalies, anomalies])
-            logging.warning(f"Anomalies détectées : {len(anomalies)} lignes")
-            logging.info(f"Détail des anomalies :\n{anomalies['rejection_reason'].value_counts().to_string()}")
+        if len(rejected):
+            reasons = codes[rejected].astype(np.int8)
+            self.anomaly_batches.append((df, rejected, reasons))
+
+            # Décompte par raison tenu à jour ici, le rapport n'a plus qu'à le lire
+            per_reason = np.bincount(reasons, minlength=len(REJECTION_REASONS))
+            counts = Counter({
+                reason: int(count)
+                for reason, count in zip(REJECTION_REASONS, per_reason)
+                if count
+            })
+            self.anomaly_counts.update(counts)
+
+            details = pd.Series(dict(counts.most_common()))
+            logging.warning(f"Anomalies détectées : {len(rejected)} lignes")
+            logging.info(f"Détail des anomalies :\n{details.to_string()}")
 
         return valid_data
 
     def add_time_features(self, df: pd.DataFrame) -> pd.DataFrame:
         """Ajoute les caractéristiques temporelles"""
-        df['pickup_hour'] = df['tpep_pickup_datetime'].dt.hour
-        df['day_of_week'] = df['tpep_pickup_datetime'].dt.day_name()
-        
-        conditions = [
-            df['pickup_hour'].between(0, 5),
-            df['pickup_hour'].between(6, 11),
-            df['pickup_hour'].between(12, 17),
-            df['pickup_hour'].between(18, 23)
-        ]
-        choices = ['Nuit', 'Matin', 'Après-midi', 'Soir']
-        
-        df['time_period'] = np.select(conditions, choices, default='Inconnu')
+        pickup = df['tpep_pickup_datetime'].to_numpy(dtype='datetime64[ns]').view('i8')
+        hours_since_epoch = pickup // 3_600_000_000_000
+        hour = (hours_since_epoch % 24).astype(np.int8)
+
+        # Le 01/01/1970 était un jeudi : décalage de 3 pour que lundi = 0
+        weekday = ((hours_since_epoch // 24 + 3) % 7).astype(np.int8)
+
+        df['pickup_hour'] = hour
+        df['day_of_week'] = pd.Categorical.from_codes(weekday, DAY_NAMES)
+        df['time_period'] = pd.Categorical.from_codes(hour // 6, TIME_PERIODS)
         return df
 
     def encode_features(self, df: pd.DataFrame) -> pd.DataFrame:
@@ -96,7 +202,7 @@ class DataTransformer:
             3: 'Gratuit',
             4: 'Conflit'
         }
-        df['payment_label'] = df['payment_type'].map(payment_labels)
+        df['payment_label'] = _encode_labels(df['payment_type'], payment_labels)
         
         ratecode_labels = {
             1: 'Standard',
@@ -106,7 +212,7 @@ class DataTransformer:
             5: 'Course partagée',
             6: 'Location'
         }
-        df['ratecode_label'] = df['RatecodeID'].map(ratecode_labels)
+        df['ratecode_label'] = _encode_labels(df['RatecodeID'], ratecode_labels)
         
         return df
 
@@ -117,26 +223,33 @@ class DataTransformer:
         # Sauvegarde des données transformées
         df.to_parquet(
             os.path.join(output_dir, 'transformed_data.parquet'),
-            compression='snappy'
+            index=False,
+            **PARQUET_OPTIONS
         )
         
         # Sauvegarde des anomalies
-        if not self.anomalies.empty:
+        if self.anomaly_batches:
             anomaly_path = os.path.join(output_dir, f"anomalies_{datetime.now().strftime('%Y%m%d_%H%M%S')}.parquet")
-            self.anomalies.to_parquet(anomaly_path)
+            self.anomalies.to_parquet(anomaly_path, index=False, **PARQUET_OPTIONS)
             logging.info(f"Anomalies sauvegardées : {anomaly_path}")
 
     def generate_report(self, output_dir: str):
         """Génère le rapport de transformation détaillé"""
+        anomaly_count = self.anomaly_count
+        metrics = self.df.agg({
+            'trip_duration': 'mean',
+            'avg_speed': 'mean',
+            'fare_amount': 'sum'
+        })
         report = {
             'timestamp': datetime.now().isoformat(),
-            'total_processed': len(self.anomalies) + len(self.df),
-            'anomaly_rate': f"{len(self.anomalies)/(len(self.anomalies)+len(self.df))*100:.2f}%",
-            'anomaly_details': self.anomalies['rejection_reason'].value_counts().to_dict(),
+            'total_processed': anomaly_count + len(self.df),
+            'anomaly_rate': f"{anomaly_count/(anomaly_count+len(self.df))*100:.2f}%",
+            'anomaly_details': dict(self.anomaly_counts.most_common()),
             'data_quality_metrics': {
-                'avg_trip_duration': self.df['trip_duration'].mean(),
-                'avg_speed': self.df['avg_speed'].mean(),
-                'total_fare_amount': self.df['fare_amount'].sum()
+                'avg_trip_duration': float(metrics['trip_duration']),
+                'avg_speed': float(metrics['avg_speed']),
+                'total_fare_amount': float(metrics['fare_amount'])
             }
         }
         
@@ -163,13 +276,14 @@ def transform_data():
         # Pipeline de transformation
         df = transformer.calculate_metrics(df)
         df = transformer.handle_anomalies(df)
+
+        # Dédoublonnage au plus tôt : les étapes suivantes n'ajoutent que des
+        # colonnes, autant ne pas les calculer pour des lignes écartées
+        df = drop_duplicate_trips(df)
+
         df = transformer.add_time_features(df)
         df = transformer.encode_features(df)
         
-        # Post-traitement
-        df = df.convert_dtypes()
-        df = df.drop_duplicates(subset=['tpep_pickup_datetime', 'tpep_dropoff_datetime'])
-        
         # Sauvegarde
         transformer.save_artifacts(df, output_dir)
         transformer.generate_report(output_dir)